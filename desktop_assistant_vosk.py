@@ -4,24 +4,86 @@ import sounddevice as sd
 import vosk
 import numpy as np
 import json
+try:
+    import orjson # Much faster parsing on the Vosk result hot path
+    json_loads, json_dumps = orjson.loads, orjson.dumps
+except ImportError:
+    json_loads, json_dumps = json.loads, lambda obj: json.dumps(obj).encode()
 import pyttsx3
 import queue
-import time
+import re
+import os
+import tempfile
+import wave
+import atexit
 import requests # For making HTTP requests to the LLM
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- CONFIGURATION ---
 VOSK_MODEL_PATH = "vosk-model-en-in-0.5"
+# Runtime grammars need a lookahead graph (graph/HCLr.fst, shipped with small and *-lgraph models).
+# Static-graph models such as the default above ignore grammars, so the cheaper wake-word-only
+# recognizer is only built when the model has one.
+USE_WAKE_GRAMMAR = os.path.exists(os.path.join(VOSK_MODEL_PATH, "graph", "HCLr.fst"))
 WAKE_WORD = "computer"
 SAMPLERATE = 16000
 CHANNELS = 1
 BLOCKSIZE = 4000
 COMMAND_TIMEOUT = 5.0 # 5 seconds of no new words
+EMPTY_PARTIAL = '"partial" : ""' # How Vosk formats a partial result with no words yet
+COMMAND_TIMEOUT_SAMPLES = int(COMMAND_TIMEOUT * SAMPLERATE) # Timeout counted in audio samples, not wall-clock time
+AUDIO_QUEUE_BLOCKS = 4 # ~1 s of captured audio buffered between PortAudio and Vosk
+SILENCE_THRESHOLD = 200 # Block RMS (int16 units) below which idle audio is not sent to Vosk
+SILENCE_HANGOVER_BLOCKS = 4 # Quiet blocks still decoded after speech, so word endings aren't clipped
+TTS_AUDIO_QUEUE_SIZE = 2 # Synthesized sentences waiting to play; bounds how far synthesis runs ahead
+MAX_COMMAND_SECONDS = 30 # Longest command window; longer commands are finalized at this point
+MAX_COMMAND_SAMPLES = SAMPLERATE * MAX_COMMAND_SECONDS
 
 # --- NEW: LLM Configuration ---
-# IMPORTANT: Change this URL to your local LLM's API endpoint.
+# IMPORTANT: Change LLM_BASE_URL to your local LLM server's address; LLM_ENDPOINT is derived from it.
 # This example is for Ollama running the llama3 model.
-LLM_ENDPOINT = "http://localhost:11434/"
+LLM_BASE_URL = "http://localhost:11434/"
+LLM_ENDPOINT = LLM_BASE_URL + "api/generate"
 LLM_MODEL = "llama3" # The model name your LLM server uses
+LLM_KEEP_ALIVE = "30m" # Ollama applies keep_alive per request (default 5m), so every request sends it
+
+try:
+    from numba import njit, types # Compiles the per-block energy gate to a tight native loop
+
+    # Eager signature: compiled at import, not on the first audio block in the listener thread.
+    # Blocks are np.frombuffer views over bytes, hence a read-only int16 array.
+    @njit(types.int64(types.Array(types.int16, 1, "C", readonly=True)), cache=True)
+    def _block_sum_squares(samples):
+        s = 0
+        for i in range(samples.size):
+            v = np.int64(samples[i])
+            s += v * v
+        return s
+except ImportError:
+    def _block_sum_squares(samples):
+        wide = samples.astype(np.int64)
+        return int(np.dot(wide, wide))
+
+def block_rms(samples):
+    return int(np.sqrt(_block_sum_squares(samples) / samples.size))
+
+# A sentence ends at a newline, or at . ! ? followed by whitespace. A terminator at the very end of
+# the buffer is held back until the next token shows whether it was "3." or "3.14".
+SENTENCE_END = re.compile(r"[.!?](?=\s)|\n")
+
+def _last_sentence_end(text):
+    cut = 0
+    for match in SENTENCE_END.finditer(text):
+        cut = match.end()
+    return cut
+
+def _parse_result(raw):
+    # Vosk output should always be valid JSON; treat a malformed result as empty rather than crash the loop
+    try:
+        return json_loads(raw)
+    except ValueError:
+        return {}
 
 class VoiceAssistantApp(ctk.CTk):
     def __init__(self):
@@ -30,8 +92,24 @@ class VoiceAssistantApp(ctk.CTk):
         # --- TTS ENGINE AND QUEUE SETUP ---
         self.engine = pyttsx3.init()
         self.speak_queue = queue.Queue()
+        # Synthesis and playback run on separate threads so the next sentence renders while one plays
+        self.audio_queue = queue.Queue(maxsize=TTS_AUDIO_QUEUE_SIZE)
+        self.tts_to_buffer = True # Cleared if the TTS driver can't render to 16-bit WAV
         self.speaker_thread = threading.Thread(target=self._speaker_thread_worker, daemon=True)
         self.speaker_thread.start()
+        self.player_thread = threading.Thread(target=self._player_thread_worker, daemon=True)
+        self.player_thread.start()
+
+        # --- LLM HTTP SESSION (keep-alive, reused across queries) ---
+        self.http = requests.Session()
+        self.http.headers.update({"Content-Type": "application/json"})
+        self.http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                               max_retries=Retry(total=2, backoff_factor=0.2)))
+        atexit.register(self.http.close)
+        threading.Thread(target=self._prewarm, daemon=True).start()
+        self.cmd_queue = queue.Queue()
+        self.llm_thread = threading.Thread(target=self._llm_worker, daemon=True)
+        self.llm_thread.start()
 
         # --- WINDOW SETUP ---
         self.title("LLM Voice Assistant")
@@ -43,16 +121,34 @@ class VoiceAssistantApp(ctk.CTk):
         self.listening_thread = None
         self.is_listening = False
         self.in_command_window = False
-        self.last_word_time = 0
-        self.command_audio_buffer = []
+        self.samples_since_word = 0
+        self.command_samples = 0
+        self.gate_hangover = 0
+        self.ui_queue = queue.Queue() # (kind, payload) events; only the Tk main loop touches widgets
 
         # --- WIDGETS ---
-        self.status_label = ctk.CTkLabel(self, text="Status: Idle", font=("Arial", 16))
+        self.status_label = ctk.CTkLabel(self, text="Status: Loading speech model...", font=("Arial", 16))
         self.status_label.grid(row=0, column=0, padx=20, pady=(20, 10))
         self.log_textbox = ctk.CTkTextbox(self, state="disabled", font=("Arial", 12))
         self.log_textbox.grid(row=1, column=0, padx=20, pady=10, sticky="nsew")
-        self.toggle_button = ctk.CTkButton(self, text="Start Listening", command=self.toggle_listening)
+        self.toggle_button = ctk.CTkButton(self, text="Start Listening", command=self.toggle_listening,
+                                           state="disabled") # Enabled once the Vosk model has loaded
         self.toggle_button.grid(row=2, column=0, padx=20, pady=20)
+        self.after(50, self._drain_ui)
+
+        # --- VOSK MODEL (loaded once, off the UI thread; recognizers are cheap to recreate per session) ---
+        self.vosk_model = None
+        threading.Thread(target=self._load_vosk_model, daemon=True).start()
+
+    def _load_vosk_model(self):
+        try:
+            self.vosk_model = vosk.Model(VOSK_MODEL_PATH)
+        except Exception as e:
+            self.log_message(f"Initialization Error: {e}")
+            self.update_status("Speech model failed to load")
+            return
+        self.ui_queue.put(("button_state", "normal"))
+        self.update_status("Idle")
 
     # --- TTS METHODS ---
     def speak(self, text):
@@ -62,77 +158,191 @@ class VoiceAssistantApp(ctk.CTk):
         while True:
             try:
                 text_to_speak = self.speak_queue.get()
-                self.engine.say(text_to_speak)
-                self.engine.runAndWait()
+                audio = self._synthesize(text_to_speak) if self.tts_to_buffer else None
+                if audio is not None:
+                    self.audio_queue.put(audio) # Blocks while the player is behind
+                else:
+                    # Driver can't render 16-bit WAV (e.g. macOS nsss writes AIFF): speak directly,
+                    # after anything already synthesized has finished playing
+                    self.audio_queue.join()
+                    self.engine.say(text_to_speak)
+                    self.engine.runAndWait()
                 self.speak_queue.task_done()
             except Exception as e:
                 print(f"Error in speaker thread: {e}")
 
+    def _synthesize(self, text):
+        fd, path = tempfile.mkstemp(suffix=".wav")
+        os.close(fd)
+        try:
+            self.engine.save_to_file(text, path)
+            self.engine.runAndWait()
+            with wave.open(path, "rb") as wav:
+                if wav.getsampwidth() != 2:
+                    raise wave.Error(f"unsupported sample width {wav.getsampwidth()}")
+                samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+                return samples.reshape(-1, wav.getnchannels()), wav.getframerate()
+        except (wave.Error, EOFError) as e:
+            print(f"TTS buffer synthesis unavailable, falling back to direct playback: {e}")
+            self.tts_to_buffer = False # Same driver every time; don't retry per sentence
+            return None
+        finally:
+            os.remove(path)
+
+    def _player_thread_worker(self):
+        while True:
+            try:
+                samples, rate = self.audio_queue.get()
+                try:
+                    sd.play(samples, rate)
+                    sd.wait()
+                finally:
+                    self.audio_queue.task_done()
+            except Exception as e:
+                print(f"Error in player thread: {e}")
+
     # --- UI & CONTROL METHODS ---
+    # These are safe to call from any thread; the widgets are updated later by _drain_ui
     def update_status(self, text):
-        self.status_label.configure(text=f"Status: {text}")
+        self.ui_queue.put(("status", text))
 
     def log_message(self, message, speak_message=True):
-        self.log_textbox.configure(state="normal")
-        self.log_textbox.insert("end", f"{message}\n")
-        self.log_textbox.see("end")
-        self.log_textbox.configure(state="disabled")
+        self.ui_queue.put(("log", message))
         if speak_message:
             self.speak(message)
 
+    def _set_button_text(self, text):
+        self.ui_queue.put(("button", text))
+
+    def _drain_ui(self):
+        try:
+            while True:
+                kind, payload = self.ui_queue.get_nowait()
+                if kind == "status":
+                    self.status_label.configure(text=f"Status: {payload}")
+                elif kind == "log":
+                    self.log_textbox.configure(state="normal")
+                    self.log_textbox.insert("end", f"{payload}\n")
+                    self.log_textbox.see("end")
+                    self.log_textbox.configure(state="disabled")
+                elif kind == "button":
+                    self.toggle_button.configure(text=payload)
+                elif kind == "button_state":
+                    self.toggle_button.configure(state=payload)
+        except queue.Empty:
+            pass
+        self.after(50, self._drain_ui)
+
     def toggle_listening(self):
         if self.is_listening: self.stop_listening()
         else: self.start_listening()
 
     def start_listening(self):
+        # A quick Stop->Start must not leave the previous session's thread and stream running
+        if self.listening_thread is not None and self.listening_thread.is_alive():
+            self.listening_thread.join()
         self.is_listening = True
-        self.toggle_button.configure(text="Stop Listening")
+        self._set_button_text("Stop Listening")
         self.listening_thread = threading.Thread(target=self.main_listener_loop, daemon=True)
         self.listening_thread.start()
 
     def stop_listening(self):
         self.is_listening = False
         self.in_command_window = False
-        self.toggle_button.configure(text="Start Listening")
+        self._set_button_text("Start Listening")
         self.update_status("Idle")
 
-    # --- REWRITTEN: CORE LISTENING LOGIC (Unchanged from previous) ---
+    # --- AUDIO CAPTURE: PortAudio pushes blocks here from its own thread ---
+    # Each session gets its own queue, so a stream that is still closing can't feed the next session.
+    # Warnings are reported once per stall; the consumer re-arms them once it has caught up.
+    def _make_audio_callback(self, audio_q, warned):
+        def audio_cb(indata, frames, t, status):
+            if status.input_overflow and not warned["overflow"]:
+                warned["overflow"] = True
+                self.log_message("Warning: audio input overflow, samples were lost.", speak_message=False)
+            data = bytes(indata)
+            try:
+                audio_q.put_nowait(data)
+            except queue.Full:
+                # Consumer fell behind; drop the oldest block so capture never stalls
+                try:
+                    audio_q.get_nowait()
+                except queue.Empty:
+                    pass
+                audio_q.put_nowait(data)
+                if not warned["drop"]:
+                    warned["drop"] = True
+                    self.log_message("Warning: audio queue full, dropping oldest blocks.", speak_message=False)
+        return audio_cb
+
+    # --- CORE LISTENING LOGIC: drains captured audio, spots the wake word, decodes the command ---
     def main_listener_loop(self):
         try:
-            vosk_model = vosk.Model(VOSK_MODEL_PATH)
-            recognizer = vosk.KaldiRecognizer(vosk_model, SAMPLERATE)
-            recognizer.SetWords(True)
+            if self.vosk_model is None:
+                raise RuntimeError(f"Vosk model could not be loaded from '{VOSK_MODEL_PATH}'")
+            command_recognizer = vosk.KaldiRecognizer(self.vosk_model, SAMPLERATE)
+            command_recognizer.SetWords(True)
+            if USE_WAKE_GRAMMAR:
+                # Idle mode only needs to spot the wake word, so it runs on a two-token grammar
+                wake_recognizer = vosk.KaldiRecognizer(self.vosk_model, SAMPLERATE, json.dumps([WAKE_WORD, "[unk]"]))
+            else:
+                wake_recognizer = command_recognizer
         except Exception as e:
             self.log_message(f"Initialization Error: {e}")
             self.stop_listening()
             return
 
         self.update_status(f"Listening for '{WAKE_WORD}'...")
-        with sd.InputStream(samplerate=SAMPLERATE, blocksize=BLOCKSIZE, dtype='int16', channels=CHANNELS) as stream:
-            while self.is_listening:
-                try:
-                    data, overflowed = stream.read(BLOCKSIZE)
-                    is_final = recognizer.AcceptWaveform(data.tobytes())
-                    partial_result = json.loads(recognizer.PartialResult())
-                    partial_text = partial_result.get('partial', '')
+        audio_q = queue.Queue(maxsize=AUDIO_QUEUE_BLOCKS)
+        warned = {"drop": False, "overflow": False}
+        try:
+            with sd.RawInputStream(samplerate=SAMPLERATE, blocksize=BLOCKSIZE, dtype='int16', channels=CHANNELS,
+                                   callback=self._make_audio_callback(audio_q, warned)):
+                preroll = None # Last block dropped by the energy gate
+                while self.is_listening:
+                    try:
+                        data = audio_q.get(timeout=0.5)
+                    except queue.Empty:
+                        continue
+                    if audio_q.empty(): # Caught up; the next stall may warn again
+                        warned["drop"] = warned["overflow"] = False
+                    samples = np.frombuffer(data, dtype=np.int16)
+                    # Energy gate: while idle, silent blocks never reach the recognizer
+                    if block_rms(samples) >= SILENCE_THRESHOLD:
+                        self.gate_hangover = SILENCE_HANGOVER_BLOCKS
+                    elif self.gate_hangover > 0:
+                        self.gate_hangover -= 1
+                    elif not self.in_command_window:
+                        preroll = data
+                        continue
+                    recognizer = command_recognizer if self.in_command_window else wake_recognizer
+                    if preroll is not None:
+                        # Feed the quiet block just before the speech onset so "com-" of the wake word isn't clipped
+                        recognizer.AcceptWaveform(preroll)
+                        preroll = None
+                    is_final = recognizer.AcceptWaveform(data)
+                    # Vosk returns '{"partial" : "..."}'; test the raw string and only parse when it matters
+                    raw_partial = recognizer.PartialResult()
 
                     if self.in_command_window:
-                        self.command_audio_buffer.append(data)
-                        if partial_text: self.last_word_time = time.time()
+                        self.command_samples += BLOCKSIZE
+                        self.samples_since_word += BLOCKSIZE
+                        if EMPTY_PARTIAL not in raw_partial: self.samples_since_word = 0
                         
                         if is_final:
-                            final_result = json.loads(recognizer.Result())
+                            final_result = _parse_result(recognizer.Result())
                             command_text = final_result.get('text', '')
                             if command_text:
                                 self.log_message(f"> Query: {command_text}", speak_message=False)
                                 self.process_command(command_text)
                             self.in_command_window = False
                             self.update_status(f"Listening for '{WAKE_WORD}'...")
-                        elif time.time() - self.last_word_time > COMMAND_TIMEOUT:
+                        elif (self.samples_since_word > COMMAND_TIMEOUT_SAMPLES
+                              or self.command_samples >= MAX_COMMAND_SAMPLES):
                             self.log_message("Timeout reached, processing command...", speak_message=False)
-                            full_command_audio = np.concatenate(self.command_audio_buffer)
-                            recognizer.AcceptWaveform(full_command_audio.tobytes())
-                            final_result = json.loads(recognizer.Result())
+                            # Every block was already fed incrementally; just flush the final hypothesis
+                            final_result = _parse_result(recognizer.FinalResult())
+                            recognizer.Reset()
                             command_text = final_result.get('text', '')
                             if command_text:
                                 self.log_message(f"> Query: {command_text}", speak_message=False)
@@ -140,19 +350,35 @@ class VoiceAssistantApp(ctk.CTk):
                             else:
                                 self.log_message("I heard something, but could not understand.")
                             self.in_command_window = False
-                            self.command_audio_buffer = []
                             self.update_status(f"Listening for '{WAKE_WORD}'...")
                     else: # Listening for wake word
-                        if WAKE_WORD in partial_text:
+                        if WAKE_WORD not in raw_partial:
+                            continue
+                        if WAKE_WORD in _parse_result(raw_partial).get('partial', ''):
                             self.in_command_window = True
-                            self.last_word_time = time.time()
-                            self.command_audio_buffer = []
+                            self.samples_since_word = 0
+                            self.command_samples = 0
                             self.update_status("Speak your query now...")
                             self.log_message(f"'{WAKE_WORD}' detected.")
-                            recognizer.Reset()
-                except Exception as e:
-                    self.log_message(f"Error during listening loop: {e}")
+                            wake_recognizer.Reset()
+                            command_recognizer.Reset()
+        except sd.PortAudioError as e:
+            self.log_message(f"Audio device error: {e}")
+            self.stop_listening()
+        except Exception as e:
+            # Anything else is a real bug; report it and reset the UI instead of dying silently
+            self.log_message(f"Error during listening loop: {e}")
+            self.stop_listening()
     
+    # --- LLM Pre-warm: open the pooled socket and load the model before the first query ---
+    def _prewarm(self):
+        try:
+            self.http.get(LLM_BASE_URL, timeout=5)
+            self.http.post(LLM_ENDPOINT, data=json_dumps({"model": LLM_MODEL, "prompt": "", "keep_alive": LLM_KEEP_ALIVE}),
+                           timeout=30)
+        except requests.exceptions.RequestException as e:
+            print(f"LLM pre-warm failed: {e}")
+
     # --- NEW: LLM Query Function ---
     def query_llm(self, prompt):
         self.log_message("Sending query to LLM...", speak_message=False)
@@ -161,29 +387,62 @@ class VoiceAssistantApp(ctk.CTk):
         payload = {
             "model": LLM_MODEL,
             "prompt": prompt,
-            "stream": False # We want the full response at once
+            "keep_alive": LLM_KEEP_ALIVE,
+            "stream": True # Speak sentences as they are generated
         }
         
         try:
-            response = requests.post(LLM_ENDPOINT, json=payload, timeout=60)
-            response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
-            
-            response_json = response.json()
-            return response_json.get("response", "No response text found in LLM output.")
+            full_text = ""
+            buffer = ""
+            # Closing the response (and reading it to the end) returns the socket to the keep-alive pool
+            with self.http.post(LLM_ENDPOINT, data=json_dumps(payload), timeout=60, stream=True) as response:
+                response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
+                for line in response.iter_lines():
+                    if not line: continue
+                    chunk = json_loads(line)
+                    token = chunk.get("response", "")
+                    full_text += token
+                    buffer += token
+                    # Hand every complete sentence to the TTS queue while the rest is still generating
+                    cut = _last_sentence_end(buffer)
+                    if cut:
+                        sentence, buffer = buffer[:cut], buffer[cut:]
+                        if sentence.strip(): self.speak(sentence.strip())
+            if buffer.strip(): self.speak(buffer.strip())
+            if not full_text:
+                full_text = "No response text found in LLM output."
+                self.speak(full_text)
+            return full_text
             
         except requests.exceptions.RequestException as e:
             error_message = f"Error connecting to LLM: {e}"
             print(error_message)
+            self.speak(error_message)
+            return error_message
+        except ValueError as e: # A malformed streamed line must not take down the LLM worker
+            error_message = f"Invalid response from LLM: {e}"
+            print(error_message)
+            self.speak(error_message)
             return error_message
 
     # --- REWRITTEN: COMMAND PROCESSING METHOD ---
     def process_command(self, text):
-        # Forward the recognized text to the LLM
-        response = self.query_llm(text)
-        
-        if response:
-            self.log_message(f"LLM Response: {response}", speak_message=False)
-            self.speak(response)
+        # Queue the recognized text for the LLM worker so the listener keeps capturing audio
+        self.cmd_queue.put(text)
+
+    def _llm_worker(self):
+        while True:
+            try:
+                text = self.cmd_queue.get()
+                # The reply is spoken while it streams
+                response = self.query_llm(text)
+                if response:
+                    self.log_message(f"LLM Response: {response}", speak_message=False)
+                if not self.in_command_window: # Don't clobber the prompt of a query already being spoken
+                    self.update_status(f"Listening for '{WAKE_WORD}'..." if self.is_listening else "Idle")
+                self.cmd_queue.task_done()
+            except Exception as e:
+                print(f"Error in LLM worker thread: {e}")
 
 if __name__ == "__main__":
     app = VoiceAssistantApp()